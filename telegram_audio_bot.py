@@ -6,9 +6,18 @@ Handles both direct file uploads and audio file links
 """
 
 import os
+import asyncio
+import contextlib
 import logging
-import subprocess
+import re
+import shutil
+import time
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application, 
     CommandHandler, 
@@ -17,11 +26,14 @@ from telegram.ext import (
     filters, 
     ContextTypes
 )
-import requests
+import aiohttp
+from aiohttp import web
+import aiofiles
+import aiosqlite
+from collections import OrderedDict
 from pathlib import Path
+from typing import AsyncIterable, Awaitable, Callable, NamedTuple
 import tempfile
-import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
 
 # Configure logging
 logging.basicConfig(
@@ -42,6 +54,9 @@ BITRATES = {
     '32': '32k'
 }
 
+# Bitrates at which voice mode encodes from 16 kHz (SILK wideband) input
+VOICE_WIDEBAND_BITRATES = ('16k', '24k')
+
 # Default bitrate from environment or use 24
 DEFAULT_BITRATE = os.environ.get('DEFAULT_BITRATE', '24')
 
@@ -51,73 +66,419 @@ DEFAULT_VOICE_MODE = True
 # Encoding timeout in seconds (default: 40 minutes = 2400 seconds)
 ENCODING_TIMEOUT = int(os.environ.get('ENCODING_TIMEOUT', '2400'))
 
+# libopus compression level / complexity (default: 8 - noticeably faster
+# than 10 with no audible difference at these bitrates)
+OPUS_COMPLEXITY = int(os.environ.get('OPUS_COMPLEXITY', '8'))
+if not 0 <= OPUS_COMPLEXITY <= 10:
+    logger.warning("OPUS_COMPLEXITY=%d is outside 0-10, clamping", OPUS_COMPLEXITY)
+    OPUS_COMPLEXITY = min(max(OPUS_COMPLEXITY, 0), 10)
 
-# Simple HTTP server for health checks
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/health' or self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'OK - Bot is running')
-        else:
-            self.send_response(404)
-            self.end_headers()
+# OSCE/BWE decoder complexity: bandwidth extension needs at least 4
+OSCE_COMPLEXITY = max(OPUS_COMPLEXITY, 4)
+
+# Max concurrent Opus remuxes (stream copies). They skip the encode queue since
+# they take milliseconds, but still spawn FFmpeg, so they get their own small cap
+MAX_CONCURRENT_REMUXES = max(1, int(os.environ.get('MAX_CONCURRENT_REMUXES', '2')))
+
+# Pin each worker's FFmpeg processes to their own cores so libopus keeps its
+# caches warm instead of migrating between cores (Linux only, set to 0 to disable)
+FFMPEG_CPU_AFFINITY = (
+    os.environ.get('FFMPEG_CPU_AFFINITY', '1') == '1' and hasattr(os, 'sched_setaffinity')
+)
+
+# Cores FFmpeg may use: all usable ones, minus the first one which is left to
+# the event loop when encodes are pinned
+ENCODE_CORES = (
+    sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+    else list(range(os.cpu_count() or 1))
+)
+if FFMPEG_CPU_AFFINITY and len(ENCODE_CORES) > 1:
+    ENCODE_CORES = ENCODE_CORES[1:]
+
+# Number of encode workers pulling from the shared queue, i.e. the cap on
+# concurrent FFmpeg processes (default: half the encode cores, which respects
+# the container's CPU set unlike os.cpu_count())
+ENCODE_WORKERS = max(1, int(
+    os.environ.get('MAX_CONCURRENT_ENCODES')
+    or len(ENCODE_CORES) // 2
+))
+
+# FFmpeg threads per encode so that workers × threads ≈ encode cores
+# (override with FFMPEG_THREADS_PER_INVOCATION)
+FFMPEG_THREADS = int(
+    os.environ.get('FFMPEG_THREADS_PER_INVOCATION')
+    or max(1, len(ENCODE_CORES) // ENCODE_WORKERS)
+)
+
+# taskset applies the affinity before FFmpeg starts, so all its threads inherit it
+TASKSET_PATH = shutil.which('taskset')
+
+# SQLite database with per-user settings (survives restarts). Keep it on a
+# persistent volume: the Docker image sets /data/settings.db
+SETTINGS_DB_PATH = os.environ.get('SETTINGS_DB_PATH', 'settings.db')
+
+# Max number of users whose settings are kept in memory (the rest stay in SQLite)
+SETTINGS_CACHE_SIZE = int(os.environ.get('SETTINGS_CACHE_SIZE', '4096'))
+
+# Scratch directory for per-request files (spooled MP4 inputs, batches). Point it
+# at tmpfs (e.g. /dev/shm/opus-bot) to keep them in RAM, but mind its size: Docker
+# gives /dev/shm only 64 MB unless run with --shm-size
+BOT_TMPDIR = os.environ.get('BOT_TMPDIR') or os.path.join(tempfile.gettempdir(), 'opus-bot')
+
+# Short in-memory inputs (e.g. voice messages) that queue up together with the
+# same settings are encoded by one FFmpeg process, up to BATCH_MAX_JOBS at once
+BATCH_MAX_JOBS = int(os.environ.get('BATCH_MAX_JOBS', '8'))
+BATCH_MAX_INPUT_SIZE = int(os.environ.get('BATCH_MAX_INPUT_SIZE', str(1024 * 1024)))
+
+# Max number of sent Opus files remembered for instant re-sending
+FILE_ID_CACHE_SIZE = int(os.environ.get('FILE_ID_CACHE_SIZE', '1024'))
+
+# Chunk size for streaming downloads into FFmpeg or to disk (1 MiB)
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Timeouts for streamed downloads: no overall limit, but give up on a stalled connection
+# (connect also bounds the wait for a free pooled connection)
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=60, sock_connect=10, sock_read=30)
+
+# Kernel buffer of the pipe into FFmpeg's stdin (Linux default is only 64 KiB)
+PIPE_BUFFER_SIZE = 1 << 20
+
+# Max simultaneous outgoing HTTP connections for URL downloads and Bot API calls
+HTTP_CONNECTION_LIMIT = 32
+
+# FFmpeg prints the input duration on stderr, e.g. "Duration: 00:03:25.41"
+DURATION_RE = re.compile(rb'Duration:\s*(\d+):(\d+):(\d+\.\d+)')
+
+# Logging options shared by all FFmpeg invocations
+FFMPEG_LOG_OPTIONS = [
+    '-nostdin',              # No interactive key handling on stdin
+    '-hide_banner',          # Skip build/config banner on stderr
+    '-nostats',              # No per-frame progress spam on stderr
+    '-loglevel', 'info',     # info still prints input Duration
+]
+
+# Input options placed before each -i: audio-only inputs need no deep probing,
+# the default 5 s / 5 MB probe can take as long as encoding a short file
+FFMPEG_INPUT_OPTIONS = [
+    '-analyzeduration', '100000',  # Analyse at most 0.1 s of media (0 would mean the 5 s default)
+    '-probesize', '32k',           # Container headers fit in the first 32 KB
+]
+
+# Key=value lines written by FFmpeg's -progress option
+PROGRESS_RE = re.compile(rb'^(\w+)=(\S*)\s*$')
+
+# Min seconds between progress updates of the status message (Telegram rate limits edits)
+PROGRESS_INTERVAL = 3
+
+# Containers FFmpeg can't demux from a pipe (the index may sit at the end of file)
+SEEKABLE_INPUT_EXTENSIONS = ('.m4a', '.m4b', '.mp4', '.mov', '.3gp')
+
+# Link detection for plain text messages (every non-command text goes through it)
+URL_RE = re.compile(r'https?://')
+AUDIO_EXT_RE = re.compile(r'\.(?:mp3|wav|flac|m4a|ogg|aac|opus)', re.IGNORECASE)
+
+
+# Static texts, built once at import instead of on every command
+HELP_TEXT = (
+    "*Как использовать:*\n\n"
+    "1️⃣ Отправь аудиофайл боту\n"
+    "2️⃣ Или отправь голосовое сообщение 🎤\n"
+    "3️⃣ Или отправь прямую ссылку на аудио\n"
+    "4️⃣ Или перешли аудио из другого чата ➡️\n\n"
+    "🎤 *Режим голоса (по умолчанию):*\n"
+    "• Application: `voip` (оптимизация для речи)\n"
+    "• Каналы: Mono (экономия ~50% места)\n"
+    "• Packet Loss: 3% компенсация\n"
+    "• Лучше для: речи, подкастов, аудиокниг\n\n"
+    "🎵 *Режим музыки:*\n"
+    "• Application: `audio` (универсальный)\n"
+    "• Каналы: Stereo (полное качество)\n"
+    "• Лучше для: музыки, стерео записей\n\n"
+    "*Переключение режимов:*\n"
+    "Используй /voice для переключения\n\n"
+    "*Примеры ссылок:*\n"
+    "`https://example.com/audio.mp3`\n"
+    "`http://example.com/music/song.wav`\n\n"
+    "*Доступные битрейты:*\n"
+    "• 16 kbps - для речи (рекомендуется в режиме голоса)\n"
+    "• 24 kbps - универсальный (по умолчанию)\n"
+    "• 32 kbps - высокое качество для музыки\n\n"
+    "*Кодек:*\n"
+    "Opus 1.6 (оптимизирован для речи и музыки)"
+)
+
+VOICE_ON_TEXT = (
+    "🎤 *Режим голоса ВКЛЮЧЕН*\n\n"
+    "*Оптимизация для речи:*\n"
+    "✅ Application: `voip` (для голоса)\n"
+    "✅ Каналы: Mono (экономия ~50%)\n"
+    "✅ Packet Loss: 3% (компенсация)\n"
+    "✅ Частоты: речевой диапазон (80Hz-8kHz)\n\n"
+    "*Идеально для:*\n"
+    "🎤 Голосовых сообщений\n"
+    "🎙️ Подкастов\n"
+    "📚 Аудиокниг\n"
+    "🗣️ Записей речи\n"
+    "📞 Звонков и интервью\n\n"
+    "*Рекомендуемый битрейт:* 16-24 kbps\n"
+    "Используй /bitrate для изменения"
+)
+
+VOICE_OFF_TEXT = (
+    "🎵 *Режим музыки ВКЛЮЧЕН*\n\n"
+    "*Универсальное качество:*\n"
+    "✅ Application: `audio` (универсальный)\n"
+    "✅ Каналы: Stereo (полное качество)\n"
+    "✅ Частоты: полный диапазон (20Hz-20kHz)\n\n"
+    "*Идеально для:*\n"
+    "🎵 Музыки\n"
+    "🎧 Стерео записей\n"
+    "🎬 Звуковых дорожек\n"
+    "🎸 Концертов\n\n"
+    "*Рекомендуемый битрейт:* 24-32 kbps\n"
+    "Используй /bitrate для изменения"
+)
+
+# Welcome text, {opus_version} is filled in once at startup
+WELCOME_TEMPLATE = (
+    "🎵 *Audio to Opus Encoder Bot*\n"
+    "_Powered by Opus {opus_version}_\n\n"
+    "Отправь мне:\n"
+    "🎧 Аудиофайл\n"
+    "🎤 Голосовое сообщение\n"
+    "🔗 Ссылку на аудио\n"
+    "📎 Пересылку из другого чата\n\n"
+    "🎤 *Режим голоса ВКЛЮЧЕН по умолчанию*\n"
+    "Оптимизировано для речи (voip + mono)\n\n"
+    "*Команды:*\n"
+    "/start - Показать это сообщение\n"
+    "/help - Справка\n"
+    "/bitrate - Выбрать битрейт (16, 24, 32 kbps)\n"
+    "/voice - Переключить режим (голос/музыка) 🎤/🎵\n"
+    "/settings - Текущие настройки\n\n"
+    "*Поддерживаемые форматы:*\n"
+    "MP3, WAV, FLAC, AAC, OGG, M4A, WMA и другие!\n\n"
+    f"*Максимальный размер:* {MAX_FILE_SIZE_MB}MB"
+)
+
+
+def build_settings_text(bitrate: str, voice_mode: bool, opus_version: str) -> str:
+    """Render the /settings reply for one bitrate / voice mode combination"""
+    # Voice mode status
+    if voice_mode:
+        mode_icon = "🎤"
+        mode_name = "Голос (voip)"
+        mode_desc = "Моно, оптимизация для речи"
+        packet_loss = "3% (компенсация)"
+    else:
+        mode_icon = "🎵"
+        mode_name = "Музыка (audio)"
+        mode_desc = "Стерео, полное качество"
+        packet_loss = "0%"
+    complexity = OPUS_COMPLEXITY
+    if complexity == 10:
+        complexity_note = " (максимальное)\n"
+    elif complexity >= 8:
+        complexity_note = f"\n   └ {complexity} кодирует заметно быстрее 10 без слышимой разницы\n"
+    else:
+        complexity_note = "\n"
+    
+    return (
+        "*Текущие настройки:*\n\n"
+        f"🔊 Битрейт: *{bitrate} kbps*\n"
+        f"{mode_icon} Режим: *{mode_name}*\n"
+        f"   └ {mode_desc}\n"
+        f"📦 Кодек: Opus {opus_version} (libopus)\n"
+        f"🎚️ VBR: Включен\n"
+        f"⚙️ Сжатие: {complexity}{complexity_note}"
+        f"🌊 BWE: Включен (Opus 1.6)\n"
+        f"🧮 Complexity: {OSCE_COMPLEXITY}\n"
+        f"📡 Packet Loss: {packet_loss}\n"
+        f"⏱️ Фрейм: 20ms\n"
+        f"📏 Макс. размер: {MAX_FILE_SIZE_MB} MB\n"
+        f"⏲️ Timeout: {ENCODING_TIMEOUT // 60} мин\n\n"
+        f"Команды:\n"
+        f"• /bitrate - изменить битрейт\n"
+        f"• /voice - переключить режим (голос/музыка)"
+    )
+
+
+# /bitrate prompt and confirmation, one variant per bitrate
+BITRATE_PROMPT_TEXTS = {
+    key: (
+        f"*Выбери битрейт:*\n\n"
+        f"Текущий: *{key} kbps*\n\n"
+        f"• 16 kbps - для речи, минимальный размер\n"
+        f"• 24 kbps - баланс качества и размера\n"
+        f"• 32 kbps - высокое качество для музыки"
+    )
+    for key in BITRATES
+}
+
+BITRATE_SET_TEXTS = {
+    key: (
+        f"✅ *Битрейт установлен: {key} kbps*\n\n"
+        f"Теперь отправь аудиофайл для конвертации!"
+    )
+    for key in BITRATES
+}
+
+
+# Bitrate button labels and callback data
+BITRATE_LABELS = {key: f"{key} kbps" for key in BITRATES}
+BITRATE_CHECKED_LABELS = {key: f"✓ {key} kbps" for key in BITRATES}
+BITRATE_CALLBACK_DATA = {key: f"bitrate_{key}" for key in BITRATES}
+
+
+def build_bitrate_keyboard(current_bitrate: str = None) -> InlineKeyboardMarkup:
+    """Create inline keyboard for bitrate selection"""
+    keyboard = []
+    for key in BITRATES:
+        labels = BITRATE_CHECKED_LABELS if current_bitrate == key else BITRATE_LABELS
+        keyboard.append([InlineKeyboardButton(labels[key], callback_data=BITRATE_CALLBACK_DATA[key])])
     
-    def log_message(self, format, *args):
-        # Suppress HTTP logs
-        pass
+    return InlineKeyboardMarkup(keyboard)
 
 
-def start_health_server(port=8000):
-    """Start HTTP server for health checks in background thread"""
+# One prebuilt keyboard per possible checkmark position
+BITRATE_KEYBOARDS = {key: build_bitrate_keyboard(key) for key in (None, *BITRATES)}
+
+
+def parse_duration(match: re.Match) -> float:
+    """Convert a DURATION_RE match to seconds"""
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def enlarge_pipe_buffer(writer: asyncio.StreamWriter, size: int = PIPE_BUFFER_SIZE):
+    """Grow a pipe's kernel buffer (Linux only) so large chunks take fewer syscalls"""
+    if fcntl is None or not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
     try:
-        server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
+        fcntl.fcntl(writer.get_extra_info('pipe').fileno(), fcntl.F_SETPIPE_SZ, size)
+    except OSError as e:
+        # Above /proc/sys/fs/pipe-max-size for unprivileged processes
+        logger.debug("Could not resize pipe buffer: %s", e)
+
+
+def build_worker_cpu_sets(workers: int) -> list[set[int] | None]:
+    """
+    Split ENCODE_CORES into one core set per encode worker
+    
+    Sets are contiguous and differ in size by at most one core, so every encode
+    core is used and no two workers share one (unless there are more workers
+    than cores). Returns None per worker when pinning is disabled, unsupported
+    or pointless (a single core).
+    """
+    if not FFMPEG_CPU_AFFINITY or len(os.sched_getaffinity(0)) < 2:
+        return [None] * workers
+    cores = ENCODE_CORES
+    if workers >= len(cores):
+        return [{cores[index % len(cores)]} for index in range(workers)]
+    base, extra = divmod(len(cores), workers)
+    cpu_sets = []
+    start = 0
+    for index in range(workers):
+        size = base + (index < extra)
+        cpu_sets.append(set(cores[start:start + size]))
+        start += size
+    return cpu_sets
+
+
+def pin_command(command: list[str], cpus: set[int] | None) -> list[str]:
+    """Prefix a command with taskset so the process and all its threads start on the given cores"""
+    if not cpus or not TASKSET_PATH:
+        return command
+    return [TASKSET_PATH, '--cpu-list', ','.join(map(str, sorted(cpus))), *command]
+
+
+def pin_process(pid: int, cpus: set[int] | None):
+    """Restrict an already spawned process to the given cores when taskset is missing"""
+    if not cpus or TASKSET_PATH:
+        return
+    try:
+        # Best effort: this only pins FFmpeg's main thread, and only from now on.
+        # Threads it creates later inherit the mask, ones it already started don't
+        os.sched_setaffinity(pid, cpus)
+    except OSError as e:
+        logger.debug("Could not set CPU affinity of %d: %s", pid, e)
+
+
+class FileTooLargeError(Exception):
+    """Raised when a download grows past MAX_FILE_SIZE"""
+
+
+class NotAudioError(Exception):
+    """Raised when a link turns out not to point to an audio file"""
+
+
+async def limit_size(chunks: AsyncIterable[bytes], max_size: int = MAX_FILE_SIZE) -> AsyncIterable[bytes]:
+    """Pass chunks through, aborting as soon as more than max_size bytes arrive"""
+    total = 0
+    async for chunk in chunks:
+        total += len(chunk)
+        if total > max_size:
+            raise FileTooLargeError(f"File exceeds {max_size // (1024*1024)}MB")
+        yield chunk
+
+
+async def iter_chunks(data: bytes | bytearray, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> AsyncIterable[bytes]:
+    """Yield an in-memory buffer in chunks for piping into FFmpeg"""
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
+
+
+# Callable returning the bot's current load for the health check response
+HEALTH_STATS_KEY = web.AppKey('stats', Callable[[], dict])
+
+
+# Simple HTTP server for health checks, served on the bot's event loop
+async def health_check(request: web.Request) -> web.Response:
+    """Answer health check requests, reporting the encode load if available"""
+    text = 'OK - Bot is running'
+    stats = request.app.get(HEALTH_STATS_KEY)
+    if stats:
+        text += ''.join(f'\n{key}: {value}' for key, value in stats().items())
+    return web.Response(text=text)
+
+
+async def start_health_server(port=8000, stats: Callable[[], dict] | None = None) -> web.AppRunner | None:
+    """Start HTTP server for health checks on the running event loop"""
+    app = web.Application()
+    if stats:
+        app[HEALTH_STATS_KEY] = stats
+    app.router.add_get('/', health_check)
+    app.router.add_get('/health', health_check)
+    runner = web.AppRunner(app, access_log=None)  # Suppress HTTP logs
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', port).start()
         logger.info(f"Health check server started on port {port}")
-        server.serve_forever()
+        return runner
     except Exception as e:
         logger.warning(f"Could not start health check server: {e}")
+        await runner.cleanup()
+        return None
 
 
 class AudioEncoder:
     """Handles audio encoding to Opus format using Opus 1.6"""
     
     @staticmethod
-    def check_opus_version() -> str:
+    async def check_opus_version() -> str:
         """Check installed Opus version"""
         try:
-            result = subprocess.run(
-                ['pkg-config', '--modversion', 'opus'],
-                capture_output=True,
-                text=True
+            proc = await asyncio.create_subprocess_exec(
+                'pkg-config', '--modversion', 'opus',
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
             )
-            return result.stdout.strip() if result.returncode == 0 else "Unknown"
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=10)
+            return stdout.decode().strip() if proc.returncode == 0 else "Unknown"
         except Exception:
             return "Unknown"
     
-    @staticmethod
-    def get_audio_duration(file_path: str) -> float:
-        """Get audio duration in seconds using ffprobe"""
-        try:
-            result = subprocess.run(
-                [
-                    'ffprobe',
-                    '-v', 'error',
-                    '-show_entries', 'format=duration',
-                    '-of', 'default=noprint_wrappers=1:nokey=1',
-                    file_path
-                ],
-                capture_output=True,
-                text=True,
-                timeout=30
-            )
-            if result.returncode == 0 and result.stdout.strip():
-                return float(result.stdout.strip())
-            return 0.0
-        except Exception as e:
-            logger.warning(f"Could not get duration: {e}")
-            return 0.0
-    
     @staticmethod
     def format_duration(seconds: float) -> str:
         """Format duration as MM:SS or HH:MM:SS"""
@@ -134,90 +495,461 @@ class AudioEncoder:
             return f"{minutes}:{secs:02d}"
     
     @staticmethod
-    def encode_to_opus(
-        input_path: str, 
-        output_path: str, 
+    def needs_seekable_input(filename: str, mime_type: str = '') -> bool:
+        """Check if input is an MP4-family container that FFmpeg can't read from a pipe"""
+        return (
+            filename.lower().endswith(SEEKABLE_INPUT_EXTENSIONS)
+            or any(kind in mime_type for kind in ('mp4', 'm4a', 'quicktime', '3gpp'))
+        )
+    
+    @staticmethod
+    def can_copy_opus(filename: str, mime_type: str, file_size: int, duration: int, bitrate: str) -> bool:
+        """Check if input is already Opus at no more than the target bitrate, so a remux is enough"""
+        if mime_type != 'audio/opus' and not filename.lower().endswith('.opus'):
+            return False
+        return bool(duration) and file_size * 8 / duration <= int(bitrate.rstrip('k')) * 1000
+    
+    @staticmethod
+    def build_output_options(bitrate: str, voice_mode: bool, threads: int = FFMPEG_THREADS) -> list[str]:
+        """
+        Build the FFmpeg output options for one Opus output
+        
+        Args:
+            bitrate: Audio bitrate (16k, 24k, or 32k)
+            voice_mode: If True, optimize for speech (voip mode + mono + packet loss)
+            threads: Number of FFmpeg threads for this encode
+            
+        Returns:
+            List of FFmpeg arguments to place before the output path
+        """
+        # Configure encoding based on voice mode
+        if voice_mode:
+            app_mode = 'voip'       # Optimize for speech
+            packet_loss = '3'       # Packet loss compensation for VoIP
+            channels = '1'          # Mono for speech
+            logger.debug("Voice mode: voip application, mono, packet loss compensation, BWE enabled")
+        else:
+            app_mode = 'audio'      # Universal mode for music
+            packet_loss = '0'       # No packet loss compensation
+            channels = None         # Keep original channels (stereo)
+            logger.debug("Music mode: audio application, original channels, BWE enabled")
+        
+        options = [
+            '-c:a', 'libopus',           # Use libopus codec (Opus 1.6)
+            '-b:a', bitrate,              # Set bitrate
+            '-vbr', 'on',                 # Enable Variable Bit Rate
+            '-compression_level', str(OPUS_COMPLEXITY),  # Encoder complexity (0-10)
+            '-application', app_mode,     # voip for speech, audio for music
+            '-frame_duration', '20',      # Frame duration in ms
+            '-packet_loss', packet_loss,  # Packet loss percentage
+            '-threads', str(threads),     # Encoder threads, bounded so parallel encodes don't oversubscribe
+        ]
+        
+        # Add BWE (Bandwidth Extension) support - NEW in Opus 1.6!
+        # Improves quality at low bitrates by extending bandwidth
+        options.extend([
+            '-enable_osce_bwe', '1',             # Enable OSCE Bandwidth Extension
+            '-complexity', str(OSCE_COMPLEXITY)  # Decoder complexity (must be 4+)
+        ])
+        
+        # Add mono downmix for voice mode
+        if channels:
+            options.extend(['-ac', channels])  # Downmix to mono
+        
+        # Low-bitrate speech is coded by SILK at 16 kHz anyway: resample once up front
+        # so the decoder/resampler hand libopus 3x fewer samples than a 48 kHz source
+        if voice_mode and bitrate in VOICE_WIDEBAND_BITRATES:
+            options.extend(['-ar', '16000'])
+        
+        return options
+    
+    @staticmethod
+    async def encode_to_opus(
+        source: str | bytes | bytearray | AsyncIterable[bytes], 
+        output_path: str | None = None, 
         bitrate: str = "24k",
         application: str = "audio",
-        voice_mode: bool = False
-    ) -> tuple[bool, str]:
+        voice_mode: bool = False,
+        threads: int = FFMPEG_THREADS,
+        on_progress: Callable[[float, float], Awaitable[None]] | None = None,
+        copy_codec: bool = False,
+        cpus: set[int] | None = None
+    ) -> tuple[bool, str, int, float, bytes | None]:
         """
-        Encode audio file to Opus format using FFmpeg with libopus
+        Encode audio to Opus format using FFmpeg with libopus
         
         Args:
-            input_path: Path to input audio file
-            output_path: Path for output Opus file
+            source: Path to input audio file, in-memory file contents, or async
+                    iterable of byte chunks; anything but a path is piped into
+                    FFmpeg's stdin while it encodes
+            output_path: Path for output Opus file, or None to collect the
+                         encoded file from FFmpeg's stdout without touching disk
             bitrate: Audio bitrate (16k, 24k, or 32k)
             application: Opus application mode (audio, voip, or lowdelay)
             voice_mode: If True, optimize for speech (voip mode + mono + packet loss)
+            threads: Number of FFmpeg threads for this encode
+            on_progress: Coroutine called with (encoded_seconds, duration_seconds)
+                         at most every PROGRESS_INTERVAL seconds
+            copy_codec: If True, input is already Opus and is only remuxed into
+                        the output container (bitrate/voice_mode are ignored)
+            cpus: Cores to pin the FFmpeg process to (None to leave it unpinned)
             
         Returns:
-            Tuple of (success, error_message)
+            Tuple of (success, error_message, input_size, duration_seconds, opus_data),
+            opus_data being None unless output_path is None and encoding succeeded
         """
+        if isinstance(source, (bytes, bytearray)):
+            source = iter_chunks(source)
+        piped = not isinstance(source, str)
+        input_name = 'pipe:0' if piped else source
+        input_size = 0
+        duration = 0.0
+        if copy_codec:
+            output_options = ['-vn', '-c:a', 'copy']  # Stream copy, no decode/encode
+        else:
+            output_options = AudioEncoder.build_output_options(bitrate, voice_mode, threads)
         try:
-            # Configure encoding based on voice mode
-            if voice_mode:
-                app_mode = 'voip'       # Optimize for speech
-                packet_loss = '3'       # Packet loss compensation for VoIP
-                channels = '1'          # Mono for speech
-                logger.info("Voice mode: voip application, mono, packet loss compensation, BWE enabled")
-            else:
-                app_mode = 'audio'      # Universal mode for music
-                packet_loss = '0'       # No packet loss compensation
-                channels = None         # Keep original channels (stereo)
-                logger.info("Music mode: audio application, original channels, BWE enabled")
-            
             # FFmpeg command for Opus encoding
             command = [
                 'ffmpeg',
-                '-i', input_path,
-                '-c:a', 'libopus',           # Use libopus codec (Opus 1.6)
-                '-b:a', bitrate,              # Set bitrate
-                '-vbr', 'on',                 # Enable Variable Bit Rate
-                '-compression_level', '10',   # Maximum compression quality
-                '-application', app_mode,     # voip for speech, audio for music
-                '-frame_duration', '20',      # Frame duration in ms
-                '-packet_loss', packet_loss,  # Packet loss percentage
+                *FFMPEG_LOG_OPTIONS,
+                '-progress', 'pipe:2',            # Machine-readable progress on stderr
+                '-threads', str(threads),         # Decoder threads
+                '-filter_threads', str(threads),  # Filter graph threads (resample/downmix)
+                *FFMPEG_INPUT_OPTIONS,
+                '-i', input_name,
+                *output_options,
+                # Ogg Opus on stdout (the muxer doesn't seek), or overwrite output file
+                *(['-f', 'opus', 'pipe:1'] if output_path is None else ['-y', output_path])
             ]
             
-            # Add BWE (Bandwidth Extension) support - NEW in Opus 1.6!
-            # Improves quality at low bitrates by extending bandwidth
-            command.extend([
-                '-enable_osce_bwe', '1',             # Enable OSCE Bandwidth Extension
-                '-complexity', '10'            # Decoder complexity (must be 4+, we use 10 for best quality)
-            ])
+            # Diagnostic only: %-args are formatted just when DEBUG is enabled, and the
+            # argv repr keeps arguments with spaces unambiguous (unlike ' '.join)
+            logger.debug("ffmpeg argv=%r", command)
             
-            # Add mono downmix for voice mode
-            if channels:
-                command.extend(['-ac', channels])  # Downmix to mono
+            proc = await asyncio.create_subprocess_exec(
+                *pin_command(command, cpus),
+                stdin=asyncio.subprocess.PIPE if piped else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE if output_path is None else asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            pin_process(proc.pid, cpus)
+            if piped:
+                enlarge_pipe_buffer(proc.stdin)
             
-            command.extend(['-y', output_path])  # Overwrite output file
+            async def feed_stdin() -> int:
+                """Write source chunks to FFmpeg as they arrive"""
+                fed = 0
+                try:
+                    async for chunk in source:
+                        proc.stdin.write(chunk)
+                        await proc.stdin.drain()
+                        fed += len(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # FFmpeg exited early, its stderr tells why
+                finally:
+                    proc.stdin.close()
+                    # Release a streamed download's connection now rather than on GC
+                    if hasattr(source, 'aclose'):
+                        await source.aclose()
+                return fed
             
-            logger.info(f"Encoding with command: {' '.join(command)}")
+            async def read_stderr() -> bytes:
+                """Drain FFmpeg stderr, picking up the input duration and progress on the way"""
+                nonlocal duration
+                output = bytearray()
+                last_report = time.monotonic()
+                encoded = 0.0
+                while line := await proc.stderr.readline():
+                    progress = PROGRESS_RE.match(line)
+                    if not progress:
+                        output += line
+                        if not duration:
+                            match = DURATION_RE.search(line)
+                            if match:
+                                duration = parse_duration(match)
+                        continue
+                    
+                    # out_time_ms is in microseconds despite its name
+                    key, value = progress.groups()
+                    if key == b'out_time_ms' and value.isdigit():
+                        encoded = int(value) / 1_000_000
+                        if not on_progress:
+                            continue
+                        now = time.monotonic()
+                        if now - last_report >= PROGRESS_INTERVAL:
+                            last_report = now
+                            try:
+                                await on_progress(encoded, duration)
+                            except Exception as e:
+                                logger.warning(f"Could not report progress: {e}")
+                
+                # Piped Ogg and MP3 without a Xing header log "Duration: N/A"
+                # (the demuxer can't seek to the end); the encoded length is exact
+                if not duration:
+                    duration = encoded
+                return bytes(output)
             
-            result = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                timeout=ENCODING_TIMEOUT  # Configurable timeout (default 30 min)
-            )
+            async def read_stdout() -> bytes | None:
+                """Collect the encoded file when FFmpeg writes it to stdout"""
+                return await proc.stdout.read() if output_path is None else None
+            
+            async def communicate() -> tuple[int, bytes, bytes | None]:
+                if piped:
+                    fed, stderr, output = await asyncio.gather(feed_stdin(), read_stderr(), read_stdout())
+                else:
+                    fed = os.path.getsize(source)
+                    stderr, output = await asyncio.gather(read_stderr(), read_stdout())
+                await proc.wait()
+                return fed, stderr, output
+            
+            try:
+                # Configurable timeout (default 40 min)
+                input_size, stderr, output = await asyncio.wait_for(communicate(), timeout=ENCODING_TIMEOUT)
+            except Exception:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
             
-            if result.returncode == 0:
-                logger.info(f"Successfully encoded {input_path} with {app_mode} mode")
-                return True, ""
+            if proc.returncode == 0:
+                logger.info("Successfully encoded %s with %s mode", input_name, 'voip' if voice_mode else 'audio')
+                return True, "", input_size, duration, output
             else:
-                error_msg = result.stderr
-                logger.error(f"FFmpeg error: {error_msg}")
-                return False, error_msg
+                full_error = stderr.decode(errors='replace').strip()
+                logger.error(f"FFmpeg error: {full_error}")
+                # Errors come last, after the input/output stream info
+                error_msg = '\n'.join(full_error.splitlines()[-5:])
+                return False, error_msg, input_size, duration, None
                 
-        except subprocess.TimeoutExpired:
+        except (FileTooLargeError, NotAudioError, aiohttp.ClientError):
+            raise  # Not an encoding problem, let the handler report it
+        except asyncio.TimeoutError:
             error_msg = f"Encoding timeout exceeded ({ENCODING_TIMEOUT // 60} minutes)"
             logger.error(error_msg)
-            return False, error_msg
+            return False, error_msg, input_size, duration, None
         except Exception as e:
             error_msg = str(e)
             logger.error(f"Encoding error: {error_msg}")
-            return False, error_msg
+            return False, error_msg, input_size, duration, None
+    
+    @staticmethod
+    async def encode_batch(
+        jobs: list[tuple[bytes | bytearray, str]],
+        bitrate: str,
+        voice_mode: bool,
+        threads: int = FFMPEG_THREADS,
+        cpus: set[int] | None = None
+    ) -> list[tuple[bool, str, int, float, bytes | None]] | None:
+        """
+        Encode several short in-memory inputs with a single FFmpeg process
+        
+        Inputs are written next to their outputs and each one is mapped to its
+        own output, so process startup and codec init are paid once per batch.
+        
+        Args:
+            jobs: List of (input_data, output_path)
+            bitrate: Audio bitrate shared by all jobs
+            voice_mode: Voice mode shared by all jobs
+            threads: Number of FFmpeg threads for the whole batch
+            cpus: Cores to pin the FFmpeg process to (None to leave it unpinned)
+            
+        Returns:
+            List of (success, error_message, input_size, duration_seconds, None) per job,
+            or None if the run failed and the jobs should be encoded one by one
+        """
+        input_paths = []
+        command = [
+            'ffmpeg',
+            *FFMPEG_LOG_OPTIONS,
+            '-threads', str(threads),
+            '-filter_threads', str(threads),
+        ]
+        output_options = AudioEncoder.build_output_options(bitrate, voice_mode, threads)
+        try:
+            for data, output_path in jobs:
+                input_path = output_path + '.input'
+                async with aiofiles.open(input_path, 'wb') as f:
+                    await f.write(data)
+                input_paths.append(input_path)
+                command.extend([*FFMPEG_INPUT_OPTIONS, '-i', input_path])
+            for index, (_, output_path) in enumerate(jobs):
+                command.extend(['-map', f'{index}:a', *output_options, '-y', output_path])
+            
+            logger.debug("Batch encoding %d files, ffmpeg argv=%r", len(jobs), command)
+            
+            proc = await asyncio.create_subprocess_exec(
+                *pin_command(command, cpus),
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            pin_process(proc.pid, cpus)
+            try:
+                _, stderr = await asyncio.wait_for(proc.communicate(), timeout=ENCODING_TIMEOUT)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise
+        except Exception as e:
+            logger.warning(f"Batch encoding error: {e}")
+            return None
+        finally:
+            for input_path in input_paths:
+                with contextlib.suppress(OSError):
+                    os.remove(input_path)
+        
+        if proc.returncode != 0:
+            # One bad input fails the whole run
+            logger.warning(f"Batch encoding of {len(jobs)} files failed: {stderr.decode(errors='replace')}")
+            return None
+        
+        # Inputs print their Duration in order; fall back to N/A if any is missing
+        durations = [parse_duration(match) for match in DURATION_RE.finditer(stderr)]
+        if len(durations) != len(jobs):
+            durations = [0.0] * len(jobs)
+        
+        logger.info("Successfully batch encoded %d files", len(jobs))
+        return [(True, "", len(data), duration, None) for (data, _), duration in zip(jobs, durations)]
+
+
+class EncodeJob(NamedTuple):
+    """A queued encode request and the future its requester awaits"""
+    source: str | bytes | bytearray | AsyncIterable[bytes]
+    output_path: str
+    bitrate: str
+    voice_mode: bool
+    on_progress: Callable[[float, float], Awaitable[None]] | None
+    future: asyncio.Future
+
+
+class EncodeQueue(asyncio.Queue):
+    """FIFO encode queue that lets a worker look at the next job without taking it"""
+    
+    def peek_nowait(self) -> EncodeJob | None:
+        """Return the job at the head of the queue, or None if it is empty"""
+        # asyncio.Queue has no public peek: this relies on its internal _queue deque
+        return self._queue[0] if self._queue else None
+
+
+class BatchEncoder:
+    """Runs bursts of short in-memory encode jobs with identical settings in one FFmpeg process"""
+    
+    def __init__(self, encoder: AudioEncoder):
+        self.encoder = encoder
+    
+    @staticmethod
+    def can_batch(job: EncodeJob) -> bool:
+        """Check if a queued job is small enough to share an FFmpeg run"""
+        return isinstance(job.source, (bytes, bytearray)) and len(job.source) <= BATCH_MAX_INPUT_SIZE
+    
+    def collect(self, first_job: EncodeJob, queue: EncodeQueue) -> list[EncodeJob]:
+        """
+        Take the run of jobs at the head of the queue that match first_job's settings
+        
+        Jobs only pile up while every worker is busy, so a lone request is never
+        delayed waiting for company. Collecting stops at the first non-matching job,
+        which stays at the head, so batching never reorders the queue.
+        """
+        batch = [first_job]
+        while len(batch) < BATCH_MAX_JOBS:
+            job = queue.peek_nowait()
+            if job is None:
+                break
+            if not job.future.cancelled() and not (
+                self.can_batch(job)
+                and (job.bitrate, job.voice_mode) == (first_job.bitrate, first_job.voice_mode)
+            ):
+                break
+            queue.get_nowait()
+            queue.task_done()
+            if not job.future.cancelled():
+                batch.append(job)
+        return batch
+    
+    async def run(self, batch: list[EncodeJob], cpus: set[int] | None = None):
+        """Encode a collected batch and resolve each job's future"""
+        futures = [job.future for job in batch]
+        try:
+            bitrate, voice_mode = batch[0].bitrate, batch[0].voice_mode
+            results = await self.encoder.encode_batch(
+                [(job.source, job.output_path) for job in batch],
+                bitrate, voice_mode, cpus=cpus
+            )
+            if results is None:
+                results = [
+                    await self.encoder.encode_to_opus(job.source, None, bitrate, voice_mode=voice_mode, cpus=cpus)
+                    for job in batch
+                ]
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class SettingsStore:
+    """Per-user settings persisted in SQLite with a bounded in-memory LRU read cache"""
+    
+    def __init__(self, db_path: str, cache_size: int = SETTINGS_CACHE_SIZE):
+        self.db_path = db_path
+        self.db = None
+        self.cache_size = cache_size
+        self.cache: OrderedDict[int, dict] = OrderedDict()
+    
+    async def open(self):
+        """Open the database and create the settings table if needed"""
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = await aiosqlite.connect(self.db_path)
+        await self.db.execute('PRAGMA journal_mode=WAL')
+        await self.db.execute(
+            'CREATE TABLE IF NOT EXISTS user_settings ('
+            'user_id INTEGER PRIMARY KEY, '
+            'bitrate TEXT NOT NULL, '
+            'voice_mode INTEGER NOT NULL)'
+        )
+        await self.db.commit()
+    
+    async def close(self):
+        """Close the database connection"""
+        if self.db:
+            await self.db.close()
+    
+    async def get(self, user_id: int) -> dict:
+        """Get user settings, falling back to defaults for new users"""
+        settings = self.cache.get(user_id)
+        if settings is not None:
+            self.cache.move_to_end(user_id)
+        else:
+            async with self.db.execute(
+                'SELECT bitrate, voice_mode FROM user_settings WHERE user_id = ?', (user_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                settings = {'bitrate': row[0], 'voice_mode': bool(row[1])}
+            else:
+                settings = {'bitrate': DEFAULT_BITRATE, 'voice_mode': DEFAULT_VOICE_MODE}
+            self.remember(user_id, settings)
+        return settings
+    
+    async def set(self, user_id: int, **changes):
+        """Update some of the user settings (write-through)"""
+        settings = {**await self.get(user_id), **changes}
+        await self.db.execute(
+            'INSERT OR REPLACE INTO user_settings (user_id, bitrate, voice_mode) VALUES (?, ?, ?)',
+            (user_id, settings['bitrate'], int(settings['voice_mode']))
+        )
+        await self.db.commit()
+        self.remember(user_id, settings)
+    
+    def remember(self, user_id: int, settings: dict):
+        """Cache user settings, evicting the least recently used users"""
+        self.cache[user_id] = settings
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
 
 
 class TelegramAudioBot:
@@ -226,95 +958,226 @@ class TelegramAudioBot:
     def __init__(self, token: str):
         self.token = token
         self.encoder = AudioEncoder()
-        # Store user preferences (bitrate)
-        self.user_settings = {}
+        # Resolved once in post_init so commands never fork pkg-config
+        self.opus_version = "Unknown"
+        self.welcome_text = ""
+        self.settings_texts = {}
+        # Per-request temp directories live under one scratch root
+        self.tmp_root = Path(BOT_TMPDIR)
+        self.tmp_root.mkdir(parents=True, exist_ok=True)
+        # User preferences (bitrate, voice mode), opened in post_init
+        self.settings = SettingsStore(SETTINGS_DB_PATH)
+        # Encode jobs are queued and processed by a fixed pool of workers
+        self.encode_queue = EncodeQueue()
+        self.batch_encoder = BatchEncoder(self.encoder)
+        self.encode_workers = []
+        self.busy_workers = 0
+        # Remuxes bypass the queue but share this small lane
+        self.remux_slots = asyncio.Semaphore(MAX_CONCURRENT_REMUXES)
+        # Shared HTTP session for URL downloads (created in post_init)
+        self.session = None
+        # Separate session for Telegram file downloads, so encode workers never
+        # wait for a connection held by a link request (created in post_init)
+        self.telegram_session = None
+        # Health check server runner (started in post_init)
+        self.health_runner = None
+        # Telegram file_id + caption of already encoded files, keyed by
+        # (file_unique_id or URL, bitrate, voice_mode), least recently used first
+        self.file_id_cache: OrderedDict[tuple[str, str, bool], tuple[str, str]] = OrderedDict()
+    
+    async def post_init(self, application: Application):
+        """Open settings store, start health check server and create shared aiohttp sessions on the bot's event loop"""
+        await self.settings.open()
+        self.opus_version = await self.encoder.check_opus_version()
+        logger.info(f"Opus version: {self.opus_version}")
+        # Texts that only depend on the Opus version are rendered once
+        self.welcome_text = WELCOME_TEMPLATE.format(opus_version=self.opus_version)
+        self.settings_texts = {
+            (bitrate, voice_mode): build_settings_text(bitrate, voice_mode, self.opus_version)
+            for bitrate in BITRATES for voice_mode in (True, False)
+        }
+        self.health_runner = await start_health_server(stats=self.get_stats)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_CONNECTION_LIMIT)
+        )
+        self.telegram_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_CONNECTION_LIMIT)
+        )
+        self.encode_workers = [
+            asyncio.create_task(self.encode_worker(cpus))
+            for cpus in build_worker_cpu_sets(ENCODE_WORKERS)
+        ]
+        logger.info(f"Started {ENCODE_WORKERS} encode workers ({FFMPEG_THREADS} FFmpeg threads each)")
+    
+    async def post_shutdown(self, application: Application):
+        """Stop encode workers and health check server, close shared aiohttp sessions and settings store"""
+        for worker in self.encode_workers:
+            worker.cancel()
+        await asyncio.gather(*self.encode_workers, return_exceptions=True)
+        if self.health_runner:
+            await self.health_runner.cleanup()
+        if self.session:
+            await self.session.close()
+        if self.telegram_session:
+            await self.telegram_session.close()
+        await self.settings.close()
+    
+    async def encode_worker(self, cpus: set[int] | None = None):
+        """Pull encode jobs from the queue and run them one at a time on the given cores"""
+        while True:
+            job = await self.encode_queue.get()
+            future = job.future
+            self.busy_workers += 1
+            try:
+                # Skip jobs whose requester has already gone away
+                if future.cancelled():
+                    continue
+                # Share one FFmpeg run with matching short jobs waiting behind this one
+                if self.batch_encoder.can_batch(job):
+                    batch = self.batch_encoder.collect(job, self.encode_queue)
+                    if len(batch) > 1:
+                        await self.batch_encoder.run(batch, cpus)
+                        continue
+                result = await self.encoder.encode_to_opus(
+                    job.source, None, job.bitrate, voice_mode=job.voice_mode,
+                    on_progress=job.on_progress, cpus=cpus
+                )
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.busy_workers -= 1
+                self.encode_queue.task_done()
+    
+    def get_stats(self) -> dict:
+        """Current encode load, reported by the health check"""
+        return {
+            'queued': self.encode_queue.qsize(),
+            'encoding': self.busy_workers,
+            'workers': len(self.encode_workers),
+        }
+    
+    def get_cached_audio(self, key: tuple[str, str, bool]) -> tuple[str, str] | None:
+        """Return (file_id, caption) of an already encoded file, if any"""
+        cached = self.file_id_cache.get(key)
+        if cached:
+            self.file_id_cache.move_to_end(key)
+        return cached
+    
+    def cache_audio(self, key: tuple[str, str, bool], sent_message, caption: str):
+        """Remember the file_id Telegram assigned to an encoded file"""
+        if not sent_message or not sent_message.audio:
+            return
+        self.file_id_cache[key] = (sent_message.audio.file_id, caption)
+        self.file_id_cache.move_to_end(key)
+        while len(self.file_id_cache) > FILE_ID_CACHE_SIZE:
+            self.file_id_cache.popitem(last=False)
+    
+    async def probe_url(self, url: str) -> tuple[int, str] | None:
+        """
+        Send a HEAD request to learn size and type of a remote file
         
-    def get_bitrate_keyboard(self, current_bitrate: str = None) -> InlineKeyboardMarkup:
-        """Create inline keyboard for bitrate selection"""
-        keyboard = []
-        for key, value in BITRATES.items():
-            label = f"{'✓ ' if current_bitrate == key else ''}{key} kbps"
-            keyboard.append([InlineKeyboardButton(label, callback_data=f"bitrate_{key}")])
+        Returns:
+            Tuple of (content_length, content_type), or None if the server
+            doesn't answer HEAD properly (the GET checks still apply then)
+        """
+        try:
+            async with self.session.head(
+                url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10)
+            ) as head:
+                if head.status >= 400:
+                    return None
+                return (
+                    int(head.headers.get('Content-Length') or 0),
+                    head.headers.get('Content-Type', '')
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"HEAD request failed for {url}: {e}")
+            return None
+    
+    async def iter_download(self, url: str) -> AsyncIterable[bytes]:
+        """Stream a Telegram file URL in DOWNLOAD_CHUNK_SIZE chunks"""
+        async with self.telegram_session.get(url, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+    
+    async def iter_link(self, url: str, has_audio_extension: bool) -> AsyncIterable[bytes]:
+        """
+        Stream an audio link, checking its size and type as soon as the GET is answered
         
-        return InlineKeyboardMarkup(keyboard)
+        Nothing is requested until the first chunk is pulled, so a queued encode
+        job doesn't hold a connection while it waits for a worker.
+        """
+        async with self.session.get(url, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            
+            # Servers that don't answer HEAD still announce the size here
+            if (response.content_length or 0) > MAX_FILE_SIZE:
+                raise FileTooLargeError(f"File exceeds {MAX_FILE_SIZE // (1024*1024)}MB")
+            
+            # Check content type
+            if 'audio' not in response.headers.get('content-type', '') and not has_audio_extension:
+                raise NotAudioError(url)
+            
+            # Abort as soon as the size limit is crossed
+            async for chunk in limit_size(response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE)):
+                yield chunk
+    
+    async def encode(
+        self,
+        source: str | bytes | bytearray | AsyncIterable[bytes],
+        output_path: str,
+        bitrate: str,
+        voice_mode: bool,
+        on_progress: Callable[[float, float], Awaitable[None]] | None = None
+    ) -> tuple[bool, str, int, float, bytes | None]:
+        """
+        Queue an encode job and wait for a worker to finish it
+        
+        Single encodes hand back the Opus data from FFmpeg's stdout; only jobs
+        that end up batched write it to output_path (opus_data is None then).
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.encode_queue.put(EncodeJob(source, output_path, bitrate, voice_mode, on_progress, future))
+        return await future
+    
+    def progress_reporter(
+        self, status_msg, bitrate: str, mode_icon: str, mode_text: str, known_duration: float = 0
+    ):
+        """Create an encode progress callback that updates the status message"""
+        async def report(encoded: float, duration: float):
+            # FFmpeg reports no duration for piped Ogg, fall back to Telegram's
+            duration = duration or known_duration
+            progress = self.encoder.format_duration(encoded)
+            if duration:
+                progress += f" / {self.encoder.format_duration(duration)} ({min(encoded / duration, 1) * 100:.0f}%)"
+            await status_msg.edit_text(
+                f"🔄 Кодирую в Opus {bitrate} kbps...\n"
+                f"{mode_icon} Режим: {mode_text}\n"
+                f"⏱️ Готово: {progress}"
+            )
+        return report
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
-        user_id = update.effective_user.id
-        if user_id not in self.user_settings:
-            self.user_settings[user_id] = {
-                'bitrate': DEFAULT_BITRATE,
-                'voice_mode': DEFAULT_VOICE_MODE  # Voice mode ON by default
-            }
-        
-        opus_version = self.encoder.check_opus_version()
-        
-        welcome_message = (
-            "🎵 *Audio to Opus Encoder Bot*\n"
-            f"_Powered by Opus {opus_version}_\n\n"
-            "Отправь мне:\n"
-            "🎧 Аудиофайл\n"
-            "🎤 Голосовое сообщение\n"
-            "🔗 Ссылку на аудио\n"
-            "📎 Пересылку из другого чата\n\n"
-            "🎤 *Режим голоса ВКЛЮЧЕН по умолчанию*\n"
-            "Оптимизировано для речи (voip + mono)\n\n"
-            "*Команды:*\n"
-            "/start - Показать это сообщение\n"
-            "/help - Справка\n"
-            "/bitrate - Выбрать битрейт (16, 24, 32 kbps)\n"
-            "/voice - Переключить режим (голос/музыка) 🎤/🎵\n"
-            "/settings - Текущие настройки\n\n"
-            "*Поддерживаемые форматы:*\n"
-            "MP3, WAV, FLAC, AAC, OGG, M4A, WMA и другие!\n\n"
-            f"*Максимальный размер:* {MAX_FILE_SIZE_MB}MB"
-        )
-        await update.message.reply_text(welcome_message, parse_mode='Markdown')
+        await update.message.reply_text(self.welcome_text, parse_mode='Markdown')
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
-        help_text = (
-            "*Как использовать:*\n\n"
-            "1️⃣ Отправь аудиофайл боту\n"
-            "2️⃣ Или отправь голосовое сообщение 🎤\n"
-            "3️⃣ Или отправь прямую ссылку на аудио\n"
-            "4️⃣ Или перешли аудио из другого чата ➡️\n\n"
-            "🎤 *Режим голоса (по умолчанию):*\n"
-            "• Application: `voip` (оптимизация для речи)\n"
-            "• Каналы: Mono (экономия ~50% места)\n"
-            "• Packet Loss: 3% компенсация\n"
-            "• Лучше для: речи, подкастов, аудиокниг\n\n"
-            "🎵 *Режим музыки:*\n"
-            "• Application: `audio` (универсальный)\n"
-            "• Каналы: Stereo (полное качество)\n"
-            "• Лучше для: музыки, стерео записей\n\n"
-            "*Переключение режимов:*\n"
-            "Используй /voice для переключения\n\n"
-            "*Примеры ссылок:*\n"
-            "`https://example.com/audio.mp3`\n"
-            "`http://example.com/music/song.wav`\n\n"
-            "*Доступные битрейты:*\n"
-            "• 16 kbps - для речи (рекомендуется в режиме голоса)\n"
-            "• 24 kbps - универсальный (по умолчанию)\n"
-            "• 32 kbps - высокое качество для музыки\n\n"
-            "*Кодек:*\n"
-            "Opus 1.6 (оптимизирован для речи и музыки)"
-        )
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+        await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
     
     async def bitrate_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /bitrate command"""
         user_id = update.effective_user.id
-        current_bitrate = self.user_settings.get(user_id, {}).get('bitrate', DEFAULT_BITRATE)
+        current_bitrate = (await self.settings.get(user_id))['bitrate']
         
-        keyboard = self.get_bitrate_keyboard(current_bitrate)
+        keyboard = BITRATE_KEYBOARDS[current_bitrate]
         
         await update.message.reply_text(
-            f"*Выбери битрейт:*\n\n"
-            f"Текущий: *{current_bitrate} kbps*\n\n"
-            f"• 16 kbps - для речи, минимальный размер\n"
-            f"• 24 kbps - баланс качества и размера\n"
-            f"• 32 kbps - высокое качество для музыки",
+            BITRATE_PROMPT_TEXTS[current_bitrate],
             reply_markup=keyboard,
             parse_mode='Markdown'
         )
@@ -327,16 +1190,12 @@ class TelegramAudioBot:
         user_id = update.effective_user.id
         bitrate = query.data.split('_')[1]
         
-        if user_id not in self.user_settings:
-            self.user_settings[user_id] = {}
-        
-        self.user_settings[user_id]['bitrate'] = bitrate
+        await self.settings.set(user_id, bitrate=bitrate)
         
-        keyboard = self.get_bitrate_keyboard(bitrate)
+        keyboard = BITRATE_KEYBOARDS[bitrate]
         
         await query.edit_message_text(
-            f"✅ *Битрейт установлен: {bitrate} kbps*\n\n"
-            f"Теперь отправь аудиофайл для конвертации!",
+            BITRATE_SET_TEXTS[bitrate],
             reply_markup=keyboard,
             parse_mode='Markdown'
         )
@@ -344,92 +1203,22 @@ class TelegramAudioBot:
     async def settings_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /settings command"""
         user_id = update.effective_user.id
-        bitrate = self.user_settings.get(user_id, {}).get('bitrate', DEFAULT_BITRATE)
-        voice_mode = self.user_settings.get(user_id, {}).get('voice_mode', DEFAULT_VOICE_MODE)
-        opus_version = self.encoder.check_opus_version()
+        settings = await self.settings.get(user_id)
+        bitrate = settings['bitrate']
+        voice_mode = settings['voice_mode']
         
-        # Voice mode status
-        if voice_mode:
-            mode_icon = "🎤"
-            mode_name = "Голос (voip)"
-            mode_desc = "Моно, оптимизация для речи"
-            packet_loss = "3% (компенсация)"
-        else:
-            mode_icon = "🎵"
-            mode_name = "Музыка (audio)"
-            mode_desc = "Стерео, полное качество"
-            packet_loss = "0%"
-        
-        settings_text = (
-            "*Текущие настройки:*\n\n"
-            f"🔊 Битрейт: *{bitrate} kbps*\n"
-            f"{mode_icon} Режим: *{mode_name}*\n"
-            f"   └ {mode_desc}\n"
-            f"📦 Кодек: Opus {opus_version} (libopus)\n"
-            f"🎚️ VBR: Включен\n"
-            f"⚙️ Сжатие: 10 (максимальное)\n"
-            f"🌊 BWE: Включен (Opus 1.6)\n"
-            f"🧮 Complexity: 10\n"
-            f"📡 Packet Loss: {packet_loss}\n"
-            f"⏱️ Фрейм: 20ms\n"
-            f"📏 Макс. размер: {MAX_FILE_SIZE_MB} MB\n"
-            f"⏲️ Timeout: {ENCODING_TIMEOUT // 60} мин\n\n"
-            f"Команды:\n"
-            f"• /bitrate - изменить битрейт\n"
-            f"• /voice - переключить режим (голос/музыка)"
-        )
-        await update.message.reply_text(settings_text, parse_mode='Markdown')
+        await update.message.reply_text(self.settings_texts[(bitrate, voice_mode)], parse_mode='Markdown')
     
     async def voice_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /voice command - toggle voice mode (voip optimization)"""
         user_id = update.effective_user.id
         
-        # Initialize if needed
-        if user_id not in self.user_settings:
-            self.user_settings[user_id] = {
-                'bitrate': DEFAULT_BITRATE,
-                'voice_mode': DEFAULT_VOICE_MODE
-            }
-        
         # Toggle voice mode
-        current_voice_mode = self.user_settings[user_id].get('voice_mode', DEFAULT_VOICE_MODE)
+        current_voice_mode = (await self.settings.get(user_id))['voice_mode']
         new_voice_mode = not current_voice_mode
-        self.user_settings[user_id]['voice_mode'] = new_voice_mode
-        
-        if new_voice_mode:
-            # Voice mode ON
-            message = (
-                "🎤 *Режим голоса ВКЛЮЧЕН*\n\n"
-                "*Оптимизация для речи:*\n"
-                "✅ Application: `voip` (для голоса)\n"
-                "✅ Каналы: Mono (экономия ~50%)\n"
-                "✅ Packet Loss: 3% (компенсация)\n"
-                "✅ Частоты: речевой диапазон (80Hz-8kHz)\n\n"
-                "*Идеально для:*\n"
-                "🎤 Голосовых сообщений\n"
-                "🎙️ Подкастов\n"
-                "📚 Аудиокниг\n"
-                "🗣️ Записей речи\n"
-                "📞 Звонков и интервью\n\n"
-                "*Рекомендуемый битрейт:* 16-24 kbps\n"
-                "Используй /bitrate для изменения"
-            )
-        else:
-            # Voice mode OFF (Music mode ON)
-            message = (
-                "🎵 *Режим музыки ВКЛЮЧЕН*\n\n"
-                "*Универсальное качество:*\n"
-                "✅ Application: `audio` (универсальный)\n"
-                "✅ Каналы: Stereo (полное качество)\n"
-                "✅ Частоты: полный диапазон (20Hz-20kHz)\n\n"
-                "*Идеально для:*\n"
-                "🎵 Музыки\n"
-                "🎧 Стерео записей\n"
-                "🎬 Звуковых дорожек\n"
-                "🎸 Концертов\n\n"
-                "*Рекомендуемый битрейт:* 24-32 kbps\n"
-                "Используй /bitrate для изменения"
-            )
+        await self.settings.set(user_id, voice_mode=new_voice_mode)
+        
+        message = VOICE_ON_TEXT if new_voice_mode else VOICE_OFF_TEXT
         
         await update.message.reply_text(message, parse_mode='Markdown')
     
@@ -439,7 +1228,8 @@ class TelegramAudioBot:
         user_id = update.effective_user.id
         
         # Get user bitrate preference
-        bitrate = self.user_settings.get(user_id, {}).get('bitrate', DEFAULT_BITRATE)
+        settings = await self.settings.get(user_id)
+        bitrate = settings['bitrate']
         bitrate_value = BITRATES[bitrate]
         
         # Get audio file
@@ -460,6 +1250,19 @@ class TelegramAudioBot:
             )
             return
         
+        # Get voice mode
+        voice_mode = settings['voice_mode']
+        mode_icon = "🎤" if voice_mode else "🎵"
+        mode_text = "voip, mono" if voice_mode else "audio, stereo"
+        
+        # Re-send a previous encode of the same file with the same settings
+        cache_key = (audio.file_unique_id, bitrate, voice_mode)
+        cached = self.get_cached_audio(cache_key)
+        if cached:
+            file_id, caption = cached
+            await message.reply_audio(audio=file_id, caption=caption)
+            return
+        
         # Send processing message
         status_msg = await message.reply_text(
             f"⏳ Скачиваю и кодирую аудио...\n"
@@ -469,62 +1272,100 @@ class TelegramAudioBot:
         
         try:
             # Create temporary directory
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Download file
+            with tempfile.TemporaryDirectory(dir=self.tmp_root) as temp_dir:
                 file = await audio.get_file()
                 input_filename = audio.file_name if hasattr(audio, 'file_name') and audio.file_name else f"audio_{audio.file_unique_id}"
-                input_path = os.path.join(temp_dir, input_filename)
-                
-                await file.download_to_drive(input_path)
                 
                 # Prepare output path
                 output_filename = Path(input_filename).stem + ".opus"
                 output_path = os.path.join(temp_dir, output_filename)
                 
-                # Get voice mode
-                voice_mode = self.user_settings.get(user_id, {}).get('voice_mode', DEFAULT_VOICE_MODE)
-                mode_icon = "🎤" if voice_mode else "🎵"
-                mode_text = "voip, mono" if voice_mode else "audio, stereo"
+                # Telegram knows the length of audio and voice (not of documents)
+                known_duration = getattr(audio, 'duration', 0) or 0
                 
-                # Get audio duration
-                duration_seconds = self.encoder.get_audio_duration(input_path)
-                duration_str = self.encoder.format_duration(duration_seconds)
-                
-                # Encode to Opus
-                await status_msg.edit_text(
-                    f"🔄 Кодирую в Opus {bitrate} kbps...\n"
-                    f"{mode_icon} Режим: {mode_text}\n"
-                    f"⏱️ Длительность: {duration_str}",
-                    parse_mode='Markdown'
+                # Voice notes recorded by Telegram clients are Opus in Ogg (bots may also
+                # send MP3/M4A ones), and so are .opus files at or below the requested
+                # bitrate: remux those instead of re-encoding
+                remux = (bool(message.voice) and audio.mime_type == 'audio/ogg') or self.encoder.can_copy_opus(
+                    input_filename, audio.mime_type or '', audio.file_size,
+                    known_duration, bitrate_value
                 )
                 
-                success, error = self.encoder.encode_to_opus(
-                    input_path, output_path, bitrate_value, voice_mode=voice_mode
-                )
+                if self.encoder.needs_seekable_input(input_filename, audio.mime_type or ''):
+                    # MP4-family containers need random access, keep them on disk
+                    # (download_to_drive would write the file synchronously on the event loop)
+                    source = os.path.join(temp_dir, input_filename)
+                    async with aiofiles.open(source, 'wb') as f:
+                        async for chunk in self.iter_download(file.file_path):
+                            await f.write(chunk)
+                elif audio.file_size > BATCH_MAX_INPUT_SIZE:
+                    # Pipe the download into FFmpeg as it arrives, so encoding overlaps
+                    # the transfer instead of waiting for the whole file
+                    source = self.iter_download(file.file_path)
+                else:
+                    # Short inputs are fetched whole so they can share a batched FFmpeg run
+                    source = await file.download_as_bytearray()
+                
+                if remux:
+                    # A stream copy takes milliseconds, no need to queue behind encodes;
+                    # Telegram streams are lazy, so waiting for a slot holds no download
+                    async with self.remux_slots:
+                        success, error, input_size, duration_seconds, opus_data = await self.encoder.encode_to_opus(
+                            source, copy_codec=True
+                        )
+                    if not success:
+                        # E.g. an .opus name on a non-Opus stream: encode it normally
+                        logger.warning(f"Remux failed, re-encoding instead: {error}")
+                        remux = False
+                        if not isinstance(source, (str, bytes, bytearray)):
+                            source = self.iter_download(file.file_path)  # The stream is used up
+                
+                if not remux:
+                    # Encode to Opus
+                    await status_msg.edit_text(
+                        f"🔄 Кодирую в Opus {bitrate} kbps...\n"
+                        f"{mode_icon} Режим: {mode_text}",
+                        parse_mode='Markdown'
+                    )
+                    
+                    success, error, input_size, duration_seconds, opus_data = await self.encode(
+                        source, output_path, bitrate_value, voice_mode,
+                        self.progress_reporter(status_msg, bitrate, mode_icon, mode_text, known_duration)
+                    )
                 
-                if success and os.path.exists(output_path):
-                    # Get file sizes
-                    input_size = os.path.getsize(input_path)
-                    output_size = os.path.getsize(output_path)
-                    compression_ratio = (1 - output_size / input_size) * 100
+                if success:  # FFmpeg exits with 0 only after writing the output
+                    # Batched encodes leave the result on disk, the rest come back in memory
+                    if opus_data is None:
+                        async with aiofiles.open(output_path, 'rb') as f:
+                            opus_data = await f.read()
+                    output_size = len(opus_data)
+                    duration_seconds = duration_seconds or known_duration
+                    if remux:
+                        compression_ratio = 0.0
+                        header = "✅ Opus без перекодирования\n📎 Исходный поток сохранён"
+                    else:
+                        compression_ratio = (1 - output_size / input_size) * 100 if input_size else 0.0
+                        header = f"✅ Opus {bitrate} kbps\n{mode_icon} {mode_text}"
+                    duration_str = self.encoder.format_duration(duration_seconds)
                     
                     # Send encoded file
                     await status_msg.edit_text("📤 Отправляю файл...")
                     
                     caption = (
-                        f"✅ Opus {bitrate} kbps\n"
-                        f"{mode_icon} {mode_text}\n"
+                        f"{header}\n"
                         f"⏱️ Длительность: {duration_str}\n"
                         f"📉 Сжатие: {compression_ratio:.1f}%\n"
                         f"📦 Размер: {output_size / 1024:.1f} KB"
                     )
                     
-                    with open(output_path, 'rb') as opus_file:
-                        await message.reply_audio(
-                            audio=opus_file,
-                            filename=output_filename,
-                            caption=caption
-                        )
+                    # InputFile keeps bytes as-is; a path or file object would be read
+                    # synchronously on the event loop (and a path left open)
+                    sent = await message.reply_audio(
+                        audio=opus_data,
+                        filename=output_filename,
+                        caption=caption
+                    )
+                    self.cache_audio(cache_key, sent, caption)
                     
                     await status_msg.delete()
                 else:
@@ -540,6 +1381,10 @@ class TelegramAudioBot:
                     )
                     logger.error(f"Full encoding error for user {user_id}: {error}")
                     
+        except aiohttp.ClientError as e:
+            # The file URL embeds the bot token, never echo the exception text
+            logger.error(f"Error downloading file from Telegram: {type(e).__name__}")
+            await status_msg.edit_text("❌ Не удалось скачать файл из Telegram. Попробуй ещё раз.")
         except Exception as e:
             logger.error(f"Error processing audio file: {str(e)}")
             await status_msg.edit_text(f"❌ Ошибка: {str(e)}")
@@ -551,13 +1396,27 @@ class TelegramAudioBot:
         url = message.text.strip()
         
         # Basic URL validation
-        if not url.startswith(('http://', 'https://')):
+        if not URL_RE.match(url):
             return  # Not a URL, ignore
         
         # Get user bitrate preference
-        bitrate = self.user_settings.get(user_id, {}).get('bitrate', DEFAULT_BITRATE)
+        settings = await self.settings.get(user_id)
+        bitrate = settings['bitrate']
         bitrate_value = BITRATES[bitrate]
         
+        # Get voice mode
+        voice_mode = settings['voice_mode']
+        mode_icon = "🎤" if voice_mode else "🎵"
+        mode_text = "voip, mono" if voice_mode else "audio, stereo"
+        
+        # Re-send a previous encode of the same URL with the same settings
+        cache_key = (url, bitrate, voice_mode)
+        cached = self.get_cached_audio(cache_key)
+        if cached:
+            file_id, caption = cached
+            await message.reply_audio(audio=file_id, caption=caption)
+            return
+        
         # Send processing message
         status_msg = await message.reply_text(
             f"⏳ Скачиваю аудио по ссылке...\n"
@@ -565,64 +1424,64 @@ class TelegramAudioBot:
             parse_mode='Markdown'
         )
         
+        has_audio_extension = AUDIO_EXT_RE.search(url) is not None
+        
         try:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Download file from URL
-                response = requests.get(url, stream=True, timeout=(10, 120))
-                response.raise_for_status()
-                
-                # Check content type
-                content_type = response.headers.get('content-type', '')
-                if 'audio' not in content_type and not any(ext in url.lower() for ext in ['.mp3', '.wav', '.flac', '.m4a', '.ogg', '.aac', '.opus']):
-                    await status_msg.edit_text("❌ Ссылка не ведёт на аудиофайл.")
-                    return
-                
-                # Get filename from URL or use default
-                filename = url.split('/')[-1].split('?')[0] or 'audio.mp3'
-                input_path = os.path.join(temp_dir, filename)
-                
-                # Save downloaded file
-                with open(input_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                
-                file_size = os.path.getsize(input_path)
-                if file_size > MAX_FILE_SIZE:
+            # Reject oversized and non-audio links before downloading anything
+            head = await self.probe_url(url)
+            if head:
+                content_length, content_type = head
+                if content_length > MAX_FILE_SIZE:
                     await status_msg.edit_text(
                         f"❌ Файл слишком большой! Максимум {MAX_FILE_SIZE // (1024*1024)}MB"
                     )
                     return
-                
+                if 'audio' not in content_type and not has_audio_extension:
+                    await status_msg.edit_text("❌ Ссылка не ведёт на аудиофайл.")
+                    return
+            
+            # Get filename from URL or use default
+            filename = url.split('/')[-1].split('?')[0] or 'audio.mp3'
+            content_type = head[1] if head else ''
+            
+            with tempfile.TemporaryDirectory(dir=self.tmp_root) as temp_dir:
                 # Prepare output path
                 output_filename = Path(filename).stem + ".opus"
                 output_path = os.path.join(temp_dir, output_filename)
                 
-                # Get voice mode
-                voice_mode = self.user_settings.get(user_id, {}).get('voice_mode', DEFAULT_VOICE_MODE)
-                mode_icon = "🎤" if voice_mode else "🎵"
-                mode_text = "voip, mono" if voice_mode else "audio, stereo"
-                
-                # Get audio duration
-                duration_seconds = self.encoder.get_audio_duration(input_path)
-                duration_str = self.encoder.format_duration(duration_seconds)
+                if self.encoder.needs_seekable_input(filename, content_type):
+                    # MP4-family containers need random access, save them to disk first
+                    # (a partial file is removed together with temp_dir on abort)
+                    source = os.path.join(temp_dir, filename)
+                    async with aiofiles.open(source, 'wb') as f:
+                        async for chunk in self.iter_link(url, has_audio_extension):
+                            await f.write(chunk)
+                else:
+                    # Pipe the download straight into FFmpeg while it encodes. The GET
+                    # starts only when a worker picks the job up, so no connection
+                    # sits idle (and times out server-side) while the job is queued
+                    source = self.iter_link(url, has_audio_extension)
                 
                 # Encode to Opus
                 await status_msg.edit_text(
                     f"🔄 Кодирую в Opus {bitrate} kbps...\n"
-                    f"{mode_icon} Режим: {mode_text}\n"
-                    f"⏱️ Длительность: {duration_str}",
+                    f"{mode_icon} Режим: {mode_text}",
                     parse_mode='Markdown'
                 )
                 
-                success, error = self.encoder.encode_to_opus(
-                    input_path, output_path, bitrate_value, voice_mode=voice_mode
+                success, error, input_size, duration_seconds, opus_data = await self.encode(
+                    source, output_path, bitrate_value, voice_mode,
+                    self.progress_reporter(status_msg, bitrate, mode_icon, mode_text)
                 )
                 
-                if success and os.path.exists(output_path):
-                    # Get file sizes
-                    input_size = os.path.getsize(input_path)
-                    output_size = os.path.getsize(output_path)
-                    compression_ratio = (1 - output_size / input_size) * 100
+                if success:  # FFmpeg exits with 0 only after writing the output
+                    # Batched encodes leave the result on disk, the rest come back in memory
+                    if opus_data is None:
+                        async with aiofiles.open(output_path, 'rb') as f:
+                            opus_data = await f.read()
+                    output_size = len(opus_data)
+                    compression_ratio = (1 - output_size / input_size) * 100 if input_size else 0.0
+                    duration_str = self.encoder.format_duration(duration_seconds)
                     
                     # Send encoded file
                     await status_msg.edit_text("📤 Отправляю файл...")
@@ -635,12 +1494,14 @@ class TelegramAudioBot:
                         f"📦 Размер: {output_size / 1024:.1f} KB"
                     )
                     
-                    with open(output_path, 'rb') as opus_file:
-                        await message.reply_audio(
-                            audio=opus_file,
-                            filename=output_filename,
-                            caption=caption
-                        )
+                    # InputFile keeps bytes as-is; a path or file object would be read
+                    # synchronously on the event loop (and a path left open)
+                    sent = await message.reply_audio(
+                        audio=opus_data,
+                        filename=output_filename,
+                        caption=caption
+                    )
+                    self.cache_audio(cache_key, sent, caption)
                     
                     await status_msg.delete()
                 else:
@@ -656,7 +1517,13 @@ class TelegramAudioBot:
                     )
                     logger.error(f"Full encoding error for user {user_id}: {error}")
                     
-        except requests.RequestException as e:
+        except FileTooLargeError:
+            await status_msg.edit_text(
+                f"❌ Файл слишком большой! Максимум {MAX_FILE_SIZE // (1024*1024)}MB"
+            )
+        except NotAudioError:
+            await status_msg.edit_text("❌ Ссылка не ведёт на аудиофайл.")
+        except aiohttp.ClientError as e:
             logger.error(f"Error downloading from URL: {str(e)}")
             await status_msg.edit_text("❌ Не удалось скачать аудио. Проверь ссылку.")
         except Exception as e:
@@ -665,8 +1532,29 @@ class TelegramAudioBot:
     
     def run(self):
         """Start the bot"""
+        # Persistent keep-alive connection pool for Bot API calls and file transfers
+        request = HTTPXRequest(
+            connection_pool_size=HTTP_CONNECTION_LIMIT,
+            http_version='1.1',
+            pool_timeout=5,
+            read_timeout=60,
+            write_timeout=60,
+            media_write_timeout=120
+        )
+        # getUpdates long-polls, so it gets its own single connection
+        get_updates_request = HTTPXRequest(http_version='1.1', read_timeout=60)
+        
         # Create application
-        application = Application.builder().token(self.token).build()
+        application = (
+            Application.builder()
+            .token(self.token)
+            .request(request)
+            .get_updates_request(get_updates_request)
+            .concurrent_updates(True)  # Let downloads of different users overlap
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         
         # Add handlers
         application.add_handler(CommandHandler("start", self.start))
@@ -711,10 +1599,6 @@ def main():
     logger.info(f"Default voice mode: {'ON (voip, mono)' if DEFAULT_VOICE_MODE else 'OFF (audio, stereo)'}")
     logger.info(f"Encoding timeout: {ENCODING_TIMEOUT} seconds ({ENCODING_TIMEOUT // 60} minutes)")
     
-    # Start health check server in background
-    health_thread = threading.Thread(target=start_health_server, daemon=True)
-    health_thread.start()
-    
     bot = TelegramAudioBot(TELEGRAM_BOT_TOKEN)
     bot.run()
 